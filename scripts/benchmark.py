@@ -4,21 +4,36 @@ Offline benchmark script for mosdns performance optimizations.
 This script runs Go benchmarks and analyzes the results.
 """
 
+import argparse
+import csv
+import operator
 import subprocess
 import re
 import sys
 import json
 import os
-from dataclasses import dataclass
-from typing import List, Dict, Optional
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 
 
 SCRIPT_DIR = Path(__file__).parent.resolve()
 PROJECT_DIR = SCRIPT_DIR.parent
 
+# attrgetter skips Python-level lambda dispatch in the sort hot path.
+_BY_NAME = operator.attrgetter('name')
 
-@dataclass
+DASH = '-' * 80
+
+_BENCH_LINE_RE = re.compile(
+    r'^(Benchmark\S+)\s+(-?\d+)\s+(\d+\.?\d*)\s+ns/op\s+(\d+)\s+B/op\s+(\d+)\s+allocs/op$'
+)
+
+
+@dataclass(slots=True, frozen=True)
 class BenchmarkResult:
     name: str
     iterations: int
@@ -26,109 +41,234 @@ class BenchmarkResult:
     bytes_per_op: int
     allocs_per_op: int
 
+    @classmethod
+    def from_line(cls, line: str) -> Optional['BenchmarkResult']:
+        """Parse one stripped `go test -bench` output line, or return None.
 
-def run_benchmark(package: str, bench_filter: str = ".") -> List[BenchmarkResult]:
-    """Run Go benchmarks for a specific package."""
+        Well-formed lines are whitespace-separated with a fixed schema, so a
+        plain split is much cheaper than the regex; the regex remains as a
+        fallback in case future Go versions change the column layout.
+        """
+        parts = line.split()
+        if (len(parts) == 8 and parts[0].startswith('Benchmark')
+                and parts[3] == 'ns/op' and parts[5] == 'B/op' and parts[7] == 'allocs/op'):
+            try:
+                return cls(
+                    name=parts[0],
+                    iterations=int(parts[1]),
+                    ns_per_op=float(parts[2]),
+                    bytes_per_op=int(parts[4]),
+                    allocs_per_op=int(parts[6])
+                )
+            except ValueError:
+                pass
+
+        match = _BENCH_LINE_RE.match(line)
+        if match:
+            return cls(
+                name=match.group(1),
+                iterations=int(match.group(2)),
+                ns_per_op=float(match.group(3)),
+                bytes_per_op=int(match.group(4)),
+                allocs_per_op=int(match.group(5))
+            )
+        return None
+
+
+def _print_table(results: List[BenchmarkResult]):
+    """Print the standard result table; expects results already sorted."""
+    print(DASH)
+    print(f"{'Benchmark':<40} {'ns/op':>12} {'B/op':>10} {'allocs/op':>10}")
+    print(DASH)
+    for r in results:
+        print(f"{r.name:<40} {r.ns_per_op:>12.2f} {r.bytes_per_op:>10} {r.allocs_per_op:>10}")
+
+
+def write_artifacts(name: str, results: List[BenchmarkResult], outdir: Path):
+    """Persist results as <name>.json plus a combined results.csv in outdir.
+
+    The artifacts let two runs be diffed (benchstat-style) without
+    re-parsing console output or rerunning the benchmarks.
+    """
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    with open(outdir / f"{name}.json", "w") as f:
+        json.dump([asdict(r) for r in results], f, indent=2)
+
+    csv_path = outdir / "results.csv"
+    write_header = not csv_path.exists()
+    with open(csv_path, "a", newline="") as f:
+        writer = csv.DictWriter(
+            f, fieldnames=["name", "ns_per_op", "bytes_per_op", "allocs_per_op"],
+            extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        for r in results:
+            writer.writerow(asdict(r))
+
+
+def _owning_package(module_path: str, packages: List[str]) -> Optional[str]:
+    """Map a `pkg:` module path from go test output to the requested pattern."""
+    for pkg in packages:
+        rel = pkg.lstrip("./").removesuffix("/...")
+        if module_path.endswith(rel) or f"/{rel}/" in f"{module_path}/":
+            return pkg
+    return None
+
+
+def run_benchmarks_multi(packages: List[str],
+                         bench_filter: str = ".",
+                         profile_dir: Optional[Path] = None) -> Dict[str, List[BenchmarkResult]]:
+    """Run Go benchmarks for several packages in one `go test` invocation.
+
+    A single invocation amortizes toolchain startup across all packages.
+    With -json, go test emits one event per output line with the owning
+    package attached, so results can be grouped without scraping the
+    human-readable `pkg:` headers.
+
+    With `profile_dir` set, CPU/mem/block profiles are written there with a
+    longer -benchtime for stabler samples. go test rejects profile flags
+    with multiple packages, so profiling falls back to one run per package.
+    """
+    if profile_dir is not None and len(packages) > 1:
+        grouped = {}
+        for pkg in packages:
+            grouped.update(run_benchmarks_multi([pkg], bench_filter, profile_dir))
+        return grouped
+
+    # -run=^$ skips the unit tests, which would otherwise run (three times,
+    # with -count=3) alongside the benchmarks; run_all_tests covers them.
+    benchtime = "5s" if profile_dir is not None else "1s"
     cmd = [
-        "go", "test", "-bench", bench_filter,
-        "-benchmem", "-benchtime=1s", "-count=3",
-        package
+        "go", "test", "-json", "-run", "^$", "-bench", bench_filter,
+        "-benchmem", f"-benchtime={benchtime}", "-count=3",
     ]
-    
+
+    if profile_dir is not None:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        stem = re.sub(r'[^\w.-]+', '_', packages[0].strip('./'))
+        for kind in ("cpu", "mem", "block"):
+            cmd.append(f"-{kind}profile={profile_dir.resolve() / f'{stem}.{kind}.prof'}")
+
+    cmd += packages
+
     print(f"Running: {' '.join(cmd)}")
-    
-    result = subprocess.run(
+
+    # Stream stdout so parsing overlaps with the (long) benchmark run instead
+    # of buffering the whole output first. stderr is merged into stdout: a
+    # separate pipe could fill up and deadlock the child while we are still
+    # draining stdout, and non-JSON lines are skipped by the parser anyway.
+    proc = subprocess.Popen(
         cmd,
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
         text=True,
-        cwd=PROJECT_DIR
+        cwd=PROJECT_DIR,
+        bufsize=1
     )
-    
-    if result.returncode != 0:
-        print(f"Error running benchmark: {result.stderr}")
-        return []
-    
-    results = []
-    pattern = r'^(Benchmark\w+)\s+-?\d+\s+(\d+\.?\d*)\s+ns/op\s+(\d+)\s+B/op\s+(\d+)\s+allocs/op$'
-    
-    for line in result.stdout.split('\n'):
-        match = re.match(pattern, line.strip())
-        if match:
-            results.append(BenchmarkResult(
-                name=match.group(1),
-                iterations=int(match.group(2)) if '.' not in match.group(2) else 0,
-                ns_per_op=float(match.group(2)),
-                bytes_per_op=int(match.group(3)),
-                allocs_per_op=int(match.group(4))
-            ))
-    
-    return results
+
+    grouped: Dict[str, List[BenchmarkResult]] = {pkg: [] for pkg in packages}
+    # test2json splits a benchmark result line into several output events
+    # (the name arrives without a newline, the measurements follow), so
+    # fragments are buffered per (Package, Test) until a newline completes
+    # the line.
+    fragments: Dict[Tuple[str, str], str] = {}
+    plain_lines = []
+    for line in proc.stdout:
+        try:
+            evt = json.loads(line)
+        except ValueError:
+            plain_lines.append(line)
+            continue
+        if evt.get("Action") != "output":
+            continue
+        key = (evt.get("Package", ""), evt.get("Test", ""))
+        buf = fragments.pop(key, "") + evt.get("Output", "")
+        if not buf.endswith("\n"):
+            fragments[key] = buf
+            continue
+        output = buf.strip()
+        if not output.startswith("Benchmark"):
+            continue
+        res = BenchmarkResult.from_line(output)
+        if res is None:
+            continue
+        pkg = _owning_package(evt.get("Package", ""), packages)
+        if pkg is not None:
+            grouped[pkg].append(res)
+
+    if proc.wait() != 0:
+        print(f"Error running benchmark: {''.join(plain_lines)}")
+        return {pkg: [] for pkg in packages}
+
+    return grouped
 
 
-def analyze_keyword_matcher():
+def run_benchmark(package: str, bench_filter: str = ".",
+                  profile_dir: Optional[Path] = None) -> List[BenchmarkResult]:
+    """Run Go benchmarks for a specific package."""
+    return run_benchmarks_multi([package], bench_filter, profile_dir)[package]
+
+
+def analyze_keyword_matcher(results: Optional[List[BenchmarkResult]] = None):
     """Analyze KeywordMatcher performance improvement."""
     print("\n" + "="*60)
     print("KEYWORD MATCHER BENCHMARK")
     print("="*60)
-    
-    results = run_benchmark("./pkg/matcher/domain/...", "Keyword")
-    
+
+    if results is None:
+        results = run_benchmark("./pkg/matcher/domain/...", "Keyword")
+
     if not results:
         print("No benchmark results found.")
         return
-    
+
+    results.sort(key=_BY_NAME)
+
+    # Old/New variants share the same sub-benchmark suffix
+    # (e.g. "/keywords_100-8"), so a prefix strip gives the comparison key
+    # directly without building intermediate strings.
     old_results = {}
     new_results = {}
-    
+
     for r in results:
-        if "Old" in r.name:
-            key = r.name.replace("Old", "").replace("_", "")
-            old_results[key] = r
-        else:
-            key = r.name.replace("New", "").replace("_", "")
-            if "Match" in r.name or "NoMatch" in r.name or "Concurrent" in r.name:
-                new_results[r.name] = r
-    
+        if (suf := r.name.removeprefix("BenchmarkKeywordMatcherOld")) != r.name:
+            old_results[suf] = r
+        elif (suf := r.name.removeprefix("BenchmarkKeywordMatcherNew")) != r.name:
+            new_results[suf] = r
+
     print("\nKeyword Matcher Results:")
-    print("-" * 80)
-    print(f"{'Benchmark':<40} {'ns/op':>12} {'B/op':>10} {'allocs/op':>10}")
-    print("-" * 80)
-    
-    for r in sorted(results, key=lambda x: x.name):
-        print(f"{r.name:<40} {r.ns_per_op:>12.2f} {r.bytes_per_op:>10} {r.allocs_per_op:>10}")
-    
+    _print_table(results)
+
     print("\nComparison (Old vs New Aho-Corasick):")
-    print("-" * 80)
-    
+    print(DASH)
+
     for old_key, old_r in sorted(old_results.items()):
-        kw_count = old_key.replace("keywords", "")
-        new_key = f"BenchmarkKeywordMatcherNewkeywords{kw_count}"
-        
-        if new_key in [r.name for r in results]:
-            new_r = next(r for r in results if r.name == new_key)
+        new_r = new_results.get(old_key)
+        if new_r is not None:
+            # "/keywords_100-8" -> "100"
+            kw_count = old_key.strip("/").removeprefix("keywords_").rsplit("-", 1)[0]
             speedup = old_r.ns_per_op / new_r.ns_per_op if new_r.ns_per_op > 0 else 0
             print(f"  keywords={kw_count}: Old={old_r.ns_per_op:.2f}ns, New={new_r.ns_per_op:.2f}ns, Speedup={speedup:.2f}x")
 
 
-def analyze_cache():
+def analyze_cache(results: Optional[List[BenchmarkResult]] = None):
     """Analyze Cache performance."""
     print("\n" + "="*60)
     print("CACHE BENCHMARK (Ristretto)")
     print("="*60)
-    
-    results = run_benchmark("./pkg/cache/...", "Cache")
-    
+
+    if results is None:
+        results = run_benchmark("./pkg/cache/...", "Cache")
+
     if not results:
         print("No benchmark results found.")
         return
     
+    results.sort(key=_BY_NAME)
+
     print("\nCache Results:")
-    print("-" * 80)
-    print(f"{'Benchmark':<40} {'ns/op':>12} {'B/op':>10} {'allocs/op':>10}")
-    print("-" * 80)
-    
-    for r in sorted(results, key=lambda x: x.name):
-        print(f"{r.name:<40} {r.ns_per_op:>12.2f} {r.bytes_per_op:>10} {r.allocs_per_op:>10}")
+    _print_table(results)
     
     print("\nKey Metrics:")
     for r in results:
@@ -136,25 +276,51 @@ def analyze_cache():
             print(f"  Mixed workload: {r.ns_per_op:.2f} ns/op, {r.allocs_per_op} allocs/op")
 
 
-def analyze_forward_selector():
+def analyze_forward_selector(results: Optional[List[BenchmarkResult]] = None):
     """Analyze Forward selector performance."""
     print("\n" + "="*60)
     print("FORWARD SELECTOR BENCHMARK")
     print("="*60)
-    
-    results = run_benchmark("./plugin/executable/forward/...", "Selector")
-    
+
+    if results is None:
+        results = run_benchmark("./plugin/executable/forward/...", "Selector")
+
     if not results:
         print("No benchmark results found. Creating inline benchmark...")
         return
     
+    results.sort(key=_BY_NAME)
+
     print("\nForward Selector Results:")
-    print("-" * 80)
-    print(f"{'Benchmark':<40} {'ns/op':>12} {'B/op':>10} {'allocs/op':>10}")
-    print("-" * 80)
-    
-    for r in sorted(results, key=lambda x: x.name):
-        print(f"{r.name:<40} {r.ns_per_op:>12.2f} {r.bytes_per_op:>10} {r.allocs_per_op:>10}")
+    _print_table(results)
+
+
+def _test_one(pkg: str) -> Tuple[str, bool, int, int, str]:
+    """Run `go test -v` for one package, returning (pkg, ok, passed, failed, stderr)."""
+    # stderr goes to a temp file instead of a pipe: a pipe could fill up and
+    # deadlock the child while we are still draining stdout.
+    with tempfile.TemporaryFile(mode="w+") as errf:
+        proc = subprocess.Popen(
+            ["go", "test", "-v", pkg],
+            stdout=subprocess.PIPE,
+            stderr=errf,
+            text=True,
+            cwd=PROJECT_DIR,
+            bufsize=1
+        )
+
+        passed = 0
+        failed = 0
+        for line in proc.stdout:
+            if "--- PASS:" in line:
+                passed += 1
+            elif "--- FAIL:" in line:
+                failed += 1
+
+        ok = proc.wait() == 0
+        errf.seek(0)
+        stderr = errf.read()
+    return pkg, ok, passed, failed, stderr
 
 
 def run_all_tests():
@@ -170,45 +336,79 @@ def run_all_tests():
         "./plugin/executable/cache/...",
     ]
     
+    # The packages are independent, so compile and run them concurrently.
+    # Results are printed in the original package order once all are done.
     all_passed = True
-    for pkg in packages:
-        print(f"\nTesting {pkg}...")
-        result = subprocess.run(
-            ["go", "test", "-v", pkg],
-            capture_output=True,
-            text=True,
-            cwd=PROJECT_DIR
-        )
-        
-        if result.returncode != 0:
-            print(f"  FAILED: {result.stderr}")
-            all_passed = False
-        else:
-            passed = result.stdout.count("--- PASS:")
-            failed = result.stdout.count("--- FAIL:")
-            print(f"  PASSED: {passed} tests, FAILED: {failed} tests")
-    
+    with ThreadPoolExecutor(max_workers=len(packages)) as ex:
+        for pkg, ok, passed, failed, stderr in ex.map(_test_one, packages):
+            print(f"\nTesting {pkg}...")
+            if not ok:
+                print(f"  FAILED: {stderr}")
+                all_passed = False
+            else:
+                print(f"  PASSED: {passed} tests, FAILED: {failed} tests")
+
     return all_passed
 
 
+# Analysis targets selectable via --packages: name -> (go package, analyzer).
+ANALYZERS = {
+    "cache": ("./pkg/cache/...", analyze_cache),
+    "keyword": ("./pkg/matcher/domain/...", analyze_keyword_matcher),
+    "forward": ("./plugin/executable/forward/...", analyze_forward_selector),
+}
+
+
 def main():
+    ap = argparse.ArgumentParser(description="Run and analyze mosdns Go benchmarks.")
+    ap.add_argument("--run-tests", action="store_true",
+                    help="run the go unit tests before benchmarking "
+                         "(skipped by default; CI usually runs them separately)")
+    ap.add_argument("--packages", nargs="+", choices=sorted(ANALYZERS),
+                    help="limit analysis to the given subsystems")
+    ap.add_argument("--profile", action="store_true",
+                    help="collect CPU/mem/block profiles under benchmarks/results/")
+    args = ap.parse_args()
+
     print("="*60)
     print("MOSDNS PERFORMANCE OPTIMIZATION BENCHMARK")
     print("="*60)
-    
+
     print("\nThis benchmark tests the following optimizations:")
     print("  1. Ristretto cache backend (replacing concurrent_map)")
     print("  2. Aho-Corasick for KeywordMatcher (O(n+m) vs O(n*m))")
     print("  3. Cached upstream selector weights")
-    
-    all_passed = run_all_tests()
-    if not all_passed:
-        print("\nWARNING: Some tests failed. Please fix before continuing.")
-        sys.exit(1)
-    
-    analyze_cache()
-    analyze_keyword_matcher()
-    
+
+    if args.run_tests:
+        all_passed = run_all_tests()
+        if not all_passed:
+            print("\nWARNING: Some tests failed. Please fix before continuing.")
+            sys.exit(1)
+
+    selected = args.packages or list(ANALYZERS)
+
+    outdir = PROJECT_DIR / "benchmarks" / "results" / datetime.now().strftime("%Y%m%dT%H%M%S")
+    profile_dir = outdir if args.profile else None
+
+    # One batched go test run for all benchmark packages; the analyzers then
+    # work off their slice of the grouped results.
+    grouped = run_benchmarks_multi(
+        [ANALYZERS[name][0] for name in selected],
+        "Cache|Keyword|Selector",
+        profile_dir
+    )
+    for name in selected:
+        pkg, analyze = ANALYZERS[name]
+        write_artifacts(name, grouped[pkg], outdir)
+        analyze(grouped[pkg])
+
+    print(f"\nResult artifacts written to {outdir}")
+
+    if profile_dir is not None:
+        print(f"\nProfiles written to {profile_dir}. Inspect with:")
+        for prof in sorted(profile_dir.glob("*.cpu.prof")):
+            print(f"  go tool pprof -http=:0 {prof}")
+
     print("\n" + "="*60)
     print("BENCHMARK COMPLETE")
     print("="*60)